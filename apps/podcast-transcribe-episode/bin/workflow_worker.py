@@ -26,7 +26,12 @@ async def _start_worker():
     factory.start()
 
 
+async def _run():
+    await _start_worker()
+
+    # Worker tasks run in the background, so keep the event loop running forever
+    await asyncio.Event().wait()
+
+
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    asyncio.ensure_future(_start_worker())
-    loop.run_forever()
+    asyncio.run(_run())
@@ -14,17 +14,23 @@ time docker run -it \
 """
 
 import argparse
+import concurrent.futures
 import dataclasses
+import fcntl
+import fnmatch
+import functools
 import getpass
-import glob
 import logging
 import multiprocessing
 import os
-import pathlib
 import shutil
 import signal
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+from typing import BinaryIO
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -41,9 +47,89 @@ def _dir_exists_and_accessible(directory: str) -> bool:
     return os.path.isdir(directory) and os.access(directory, os.X_OK)
 
 
+def _pg_upgrade_jobs(main_dir: str) -> int:
+    """
+    Return the number of parallel jobs to pass to pg_upgrade's --jobs.
+
+    pg_upgrade parallelizes only across databases and tablespaces, so there's no point in running more jobs than there
+    are (tablespace, database) combinations.
+
+    :param main_dir: Old cluster's main (data) directory, e.g. /var/lib/postgresql/11/main.
+    :return: Number of jobs to run pg_upgrade with.
+    """
+    tablespace_dir = os.path.join(main_dir, 'pg_tblspc')
+    if os.path.isdir(tablespace_dir):
+        with os.scandir(tablespace_dir) as entries:
+            num_tablespaces = len([entry for entry in entries if entry.is_symlink()])
+    else:
+        num_tablespaces = 0
+
+    # Every database (including templates) gets its own directory under base/ named after its OID; skip others such as
+    # pgsql_tmp
+    with os.scandir(os.path.join(main_dir, 'base')) as entries:
+        num_databases = len([entry for entry in entries if entry.is_dir() and entry.name.isdigit()])
+
+    return max(1, min(multiprocessing.cpu_count(), max(1, num_tablespaces) * num_databases))
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hardlink file, or copy it if hardlinking is not possible (e.g. source is on a different device)."""
+    try:
+        os.link(src, dst)
+    except OSError as ex:
+        logging.debug(f"Unable to hardlink {src} to {dst}, will copy instead: {ex}")
+        shutil.copy2(src, dst)
+
+
+# ioctl() request for cloning a file on copy-on-write filesystems, from <linux/fs.h>
+_FICLONE = 0x40049409
+
+
+def _filesystem_supports_cloning(directory: str) -> bool:
+    """
+    Test whether the filesystem that a directory is on supports cloning (reflinking) files.
+
+    :param directory: Directory to test in.
+    :return: True if files can be cloned in the directory, e.g. on Btrfs or XFS with reflinks enabled.
+    """
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='pg_upgrade_clone_test_') as src:
+        src.write(b'clone test')
+        src.flush()
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='pg_upgrade_clone_test_') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            except OSError as ex:
+                logging.debug(f"Unable to clone files in {directory}: {ex}")
+                return False
+    return True
+
+
 def _ram_size_mb() -> int:
     """Return RAM size (in megabytes) that is allocated to the container."""
-    ram_size = int(subprocess.check_output(['/container_memory_limit.sh']).decode('utf-8'))
+
+    # Same logic as in /container_memory_limit.sh but without forking a shell
+    for cgroup_memory_limit_file in [
+        # Pre-5.8.0 kernels
+        '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+        # Post-5.8.0 kernels
+        '/sys/fs/cgroup/memory.max',
+    ]:
+        if os.path.exists(cgroup_memory_limit_file):
+            with open(cgroup_memory_limit_file, 'r') as f:
+                cgroup_memory_limit = f.read().strip()
+
+            total_ram_size = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            if cgroup_memory_limit == 'max' or int(cgroup_memory_limit) > total_ram_size:
+                memory_limit = total_ram_size
+            else:
+                memory_limit = int(cgroup_memory_limit)
+
+            ram_size = int(memory_limit / 1024 / 1024)
+            break
+
+    else:
+        ram_size = int(subprocess.check_output(['/container_memory_limit.sh']).decode('utf-8'))
+
     assert ram_size, "RAM size can't be zero."
     return ram_size
 
@@ -66,6 +152,7 @@ class _PostgresVersion(object):
     ]
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def _current_postgresql_config_path(cls) -> str:
         """
         Returns path to currently present PostgreSQL configuration directory.
@@ -141,7 +228,7 @@ class _PostgresVersion(object):
                     raise PostgresUpgradeError(f"{postmaster_pid_path} exists; is the database running?")
 
         # Create run directory
-        pathlib.Path(f"/var/run/postgresql/{version}-main.pg_stat_tmp/").mkdir(parents=True, exist_ok=True)
+        os.makedirs(f"/var/run/postgresql/{version}-main.pg_stat_tmp/", exist_ok=True)
 
         self.bin_dir = f"/usr/lib/postgresql/{version}/bin/"
 
@@ -173,9 +260,18 @@ class _PostgresVersion(object):
         if os.path.exists(self.tmp_conf_dir):
             shutil.rmtree(self.tmp_conf_dir)
         current_postgresql_config_path = self._current_postgresql_config_path()
-        shutil.copytree(current_postgresql_config_path, self.tmp_conf_dir)
 
-        with open(os.path.join(self.tmp_conf_dir, 'postgresql.conf'), 'a') as postgresql_conf:
+        # Configuration files are read-only inputs so hardlink them instead of copying
+        shutil.copytree(current_postgresql_config_path, self.tmp_conf_dir, copy_function=_link_or_copy)
+
+        # postgresql.conf might be hardlinked to the original so write a new file instead of appending to it
+        tmp_postgresql_conf_path = os.path.join(self.tmp_conf_dir, 'postgresql.conf')
+        with open(tmp_postgresql_conf_path, 'r') as postgresql_conf:
+            original_postgresql_conf = postgresql_conf.read()
+        os.unlink(tmp_postgresql_conf_path)
+
+        with open(tmp_postgresql_conf_path, 'w') as postgresql_conf:
+            postgresql_conf.write(original_postgresql_conf)
             postgresql_conf.write(f"""
 
             port = {port}
@@ -202,6 +298,10 @@ class _PostgresVersionPair(object):
     new_version: _PostgresVersion
 
 
+# How long to wait (in seconds) for PostgreSQL to log that it's ready before falling back to polling with pg_isready
+_POSTGRES_READY_LOG_TIMEOUT = 10
+
+
 class _PostgreSQLServer(object):
     """PostgreSQL server helper."""
 
@@ -236,25 +336,62 @@ class _PostgreSQLServer(object):
         assert not self.__proc, "PostgreSQL is already started."
 
         logging.info("Starting PostgreSQL...")
-        self.__proc = subprocess.Popen([
-            os.path.join(self.__bin_dir, 'postgres'),
-            '-D', self.__data_dir,
-            '-c', f'config_file={self.__conf_dir}/postgresql.conf',
-        ])
+        self.__proc = subprocess.Popen(
+            [
+                os.path.join(self.__bin_dir, 'postgres'),
+                '-D', self.__data_dir,
+                '-c', f'config_file={self.__conf_dir}/postgresql.conf',
+            ],
+            stderr=subprocess.PIPE,
+        )
 
-        # Waiting for port is not enough as PostgreSQL might be recovering
+        # PostgreSQL logs to STDERR, so wait for it to tell us that it's ready instead of polling; keep forwarding the
+        # log afterwards so that PostgreSQL doesn't block on a full pipe
+        ready_logged = threading.Event()
+        threading.Thread(
+            target=self.__forward_stderr,
+            args=(self.__proc.stderr, ready_logged),
+            daemon=True,
+        ).start()
+
+        # Log message might be localized, logged elsewhere or not logged at all, so don't wait for it for too long
+        if not ready_logged.wait(timeout=_POSTGRES_READY_LOG_TIMEOUT):
+            logging.debug(f"PostgreSQL didn't log being ready in {_POSTGRES_READY_LOG_TIMEOUT} seconds")
+
+        # Waiting for port is not enough as PostgreSQL might be recovering; also a fallback for when the log message
+        # above didn't show up
+        logging.info("Waiting for PostgreSQL to come up...")
+        retry_interval = 0.05
         while True:
+            if self.__proc.poll() is not None:
+                raise PostgresUpgradeError(f"PostgreSQL exited with code {self.__proc.returncode} while starting up.")
             try:
                 subprocess.check_call([os.path.join(self.__bin_dir, 'pg_isready'), '--port', str(self.__port)])
             except subprocess.CalledProcessError as ex:
                 logging.debug(f"pg_isready failed: {ex}")
-                logging.info("Waiting for PostgreSQL to come up...")
-                time.sleep(1)
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, 1)
             else:
                 break
 
         logging.info("PostgreSQL is up!")
 
+    @staticmethod
+    def __forward_stderr(stderr: BinaryIO, ready_logged: threading.Event) -> None:
+        # Forward raw bytes so that log lines in an unexpected encoding don't stop us from draining the pipe
+        for line in stderr:
+            try:
+                sys.stderr.buffer.write(line)
+                sys.stderr.buffer.flush()
+            except OSError as ex:
+                logging.debug(f"Unable to forward PostgreSQL log line: {ex}")
+
+            if b'ready to accept connections' in line:
+                ready_logged.set()
+
+        # PostgreSQL has exited so there's nothing to wait for anymore
+        ready_logged.set()
+
     def stop(self) -> None:
         assert self.__proc, "PostgreSQL has not been started."
 
@@ -267,6 +404,44 @@ class _PostgreSQLServer(object):
         self.__proc = None
 
 
+def _initdb(version: _PostgresVersion) -> str:
+    """
+    Initialize a new, empty cluster for a target version.
+
+    initdb might be running concurrently with other initdbs / pg_upgrade, so its output gets captured instead of being
+    printed right away.
+
+    :param version: Target version to initialize the cluster for.
+    :return: initdb's output (STDOUT and STDERR).
+    """
+    logging.info(f"Running initdb for version {version.version}...")
+    os.makedirs(version.main_dir, exist_ok=True)
+    initdb = subprocess.run(
+        [
+            version.initdb,
+            '--pgdata', version.main_dir,
+
+            # At the time of writing we don't use checksums so we can't enable them here; once (if) they get enabled,
+            # this needs to be uncommented
+            # '--data-checksums',
+
+            '--encoding', 'UTF-8',
+            '--lc-collate', 'en_US.UTF-8',
+            '--lc-ctype', 'en_US.UTF-8',
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = initdb.stdout.decode('utf-8', errors='backslashreplace')
+
+    if initdb.returncode != 0:
+        raise PostgresUpgradeError(
+            f"initdb for version {version.version} failed with exit code {initdb.returncode}:\n\n{output}"
+        )
+
+    return output
+
+
 def postgres_upgrade(source_version: int, target_version: int) -> None:
     """
     Upgrade PostgreSQL from source version up to target version.
@@ -303,10 +478,11 @@ def postgres_upgrade(source_version: int, target_version: int) -> None:
         'pg_*.custom',
         'pg_upgrade_dump_globals.sql',
     ]
-    for pattern in patterns:
-        for file in glob.glob(os.path.join(POSTGRES_DATA_DIR, pattern)):
-            logging.debug(f"Deleting {file}...")
-            os.unlink(pattern)
+    with os.scandir(POSTGRES_DATA_DIR) as entries:
+        for entry in entries:
+            if any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in patterns):
+                logging.debug(f"Deleting {entry.path}...")
+                os.unlink(entry.path)
 
     new_maintenance_work_mem = int(_ram_size_mb() / 10)
     logging.info(f"New maintenance work memory limit: {new_maintenance_work_mem} MB")
@@ -347,62 +523,90 @@ def postgres_upgrade(source_version: int, target_version: int) -> None:
     proc.start()
     proc.stop()
 
-    for pair in upgrade_pairs:
-
-        logging.info(f"Upgrading from {pair.old_version.version} to {pair.new_version.version}...")
-
-        logging.info("Running initdb...")
-        pathlib.Path(pair.new_version.main_dir).mkdir(parents=True, exist_ok=True)
-        subprocess.check_call([
-            pair.new_version.initdb,
-            '--pgdata', pair.new_version.main_dir,
-
-            # At the time of writing we don't use checksums so we can't enable them here; once (if) they get enabled,
-            # this needs to be uncommented
-            # '--data-checksums',
-
-            '--encoding', 'UTF-8',
-            '--lc-collate', 'en_US.UTF-8',
-            '--lc-ctype', 'en_US.UTF-8',
-        ])
-
-        upgrade_command = [
-            pair.new_version.pg_upgrade,
-            '--jobs', str(multiprocessing.cpu_count()),
-            '--old-bindir', pair.old_version.bin_dir,
-            '--new-bindir', pair.new_version.bin_dir,
-            '--old-datadir', pair.old_version.main_dir,
-            '--new-datadir', pair.new_version.main_dir,
-            '--old-port', str(pair.old_version.port),
-            '--new-port', str(pair.new_version.port),
-            '--old-options', f" -c config_file={pair.old_version.tmp_conf_dir}/postgresql.conf",
-            '--new-options', f" -c config_file={pair.new_version.tmp_conf_dir}/postgresql.conf",
-            '--link',
-            '--verbose',
-        ]
-
-        logging.info("Testing if clusters are compatible...")
-        subprocess.check_call(upgrade_command + ['--check'], cwd=POSTGRES_DATA_DIR)
-
-        logging.info("Upgrading...")
-        subprocess.check_call(upgrade_command, cwd=POSTGRES_DATA_DIR)
-
-        logging.info("Cleaning up old data directory...")
-        shutil.rmtree(pair.old_version.data_dir)
-
-        logging.info("Cleaning up scripts...")
-        for script in [
-            'analyze_new_cluster.sh',
-            'delete_old_cluster.sh',
-            'pg_upgrade_internal.log',
-            'pg_upgrade_server.log',
-            'pg_upgrade_utility.log',
-        ]:
-            script_path = os.path.join(POSTGRES_DATA_DIR, script)
-            if os.path.isfile(script_path):
-                os.unlink(script_path)
-
-        logging.info(f"Done upgrading from {pair.old_version.version} to {pair.new_version.version}")
+    # Cloning is as fast as hardlinking but leaves the old cluster usable if pg_upgrade fails mid-way
+    if _filesystem_supports_cloning(POSTGRES_DATA_DIR):
+        logging.info("Filesystem supports cloning files, will use --clone")
+        transfer_mode = '--clone'
+    else:
+        logging.info("Filesystem doesn't support cloning files, will use --link")
+        transfer_mode = '--link'
+
+    # New clusters don't depend on each other's data so initialize them all while the upgrades are running
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(upgrade_pairs)) as initdb_executor:
+        initdb_futures = {
+            pair.new_version.version: initdb_executor.submit(_initdb, pair.new_version)
+            for pair in upgrade_pairs
+        }
+
+        # Versions for which pg_upgrade has started writing to the new cluster
+        upgrade_started_versions = set()
+
+        try:
+            for pair in upgrade_pairs:
+
+                logging.info(f"Upgrading from {pair.old_version.version} to {pair.new_version.version}...")
+
+                logging.info("Waiting for initdb to finish...")
+                initdb_output = initdb_futures[pair.new_version.version].result()
+                for line in initdb_output.splitlines():
+                    logging.info(f"initdb {pair.new_version.version}: {line}")
+
+                upgrade_command = [
+                    pair.new_version.pg_upgrade,
+                    '--jobs', str(_pg_upgrade_jobs(main_dir=pair.old_version.main_dir)),
+                    '--old-bindir', pair.old_version.bin_dir,
+                    '--new-bindir', pair.new_version.bin_dir,
+                    '--old-datadir', pair.old_version.main_dir,
+                    '--new-datadir', pair.new_version.main_dir,
+                    '--old-port', str(pair.old_version.port),
+                    '--new-port', str(pair.new_version.port),
+                    '--old-options', f" -c config_file={pair.old_version.tmp_conf_dir}/postgresql.conf",
+                    '--new-options', f" -c config_file={pair.new_version.tmp_conf_dir}/postgresql.conf",
+                    transfer_mode,
+                    '--verbose',
+                ]
+
+                # Non-"--check" pg_upgrade runs do the same checks before changing anything anyway, so only do a
+                # separate check run for the first pair to fail early and avoid dumping the schema twice for every pair
+                if pair is upgrade_pairs[0]:
+                    logging.info("Testing if clusters are compatible...")
+                    subprocess.check_call(upgrade_command + ['--check'], cwd=POSTGRES_DATA_DIR)
+
+                logging.info("Upgrading...")
+                upgrade_started_versions.add(pair.new_version.version)
+                subprocess.check_call(upgrade_command, cwd=POSTGRES_DATA_DIR)
+
+                logging.info("Cleaning up old data directory...")
+                shutil.rmtree(pair.old_version.data_dir)
+
+                logging.info("Cleaning up scripts...")
+                for script in [
+                    'analyze_new_cluster.sh',
+                    'delete_old_cluster.sh',
+                    'pg_upgrade_internal.log',
+                    'pg_upgrade_server.log',
+                    'pg_upgrade_utility.log',
+                ]:
+                    script_path = os.path.join(POSTGRES_DATA_DIR, script)
+                    if os.path.isfile(script_path):
+                        os.unlink(script_path)
+
+                logging.info(f"Done upgrading from {pair.old_version.version} to {pair.new_version.version}")
+
+        except BaseException:
+            # Clusters that pg_upgrade didn't get to yet contain only initdb's output, so remove them to not make the
+            # next attempt fail on new data directories already existing
+            for future in initdb_futures.values():
+                future.cancel()
+            concurrent.futures.wait(initdb_futures.values())
+
+            for pair in upgrade_pairs:
+                if pair.new_version.version not in upgrade_started_versions:
+                    if os.path.exists(pair.new_version.data_dir):
+                        logging.info(f"Removing unused new data directory {pair.new_version.data_dir}...")
+                        shutil.rmtree(pair.new_version.data_dir)
+
+            raise
 
     current_version = upgrade_pairs[-1].new_version
 